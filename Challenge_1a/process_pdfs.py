@@ -1,85 +1,112 @@
+import gc
+import io
 import os
-import json
 import re
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-import pdfplumber
+import orjson
+import pymupdf
 from pypdf import PdfReader
+from pypdf.errors import PdfReadError
 
-def extract_title_from_metadata(pdf_path):
+# Heading patterns: numbered sections (1. or 1), Title Case, ALL CAPS,
+# section numbers like 2.1
+_HEADING_RE = re.compile(r'^(?:\d+\.?\s+|[A-Z][a-z]*\s+[A-Z]|[A-Z\s]+$|\w+\.\d+)')
+
+# Text this much larger than the document's average font size counts as a heading
+_HEADING_SIZE_RATIO = 1.1
+
+# pypdf raises more than PdfReadError on malformed metadata and outlines
+_PYPDF_ERRORS = (PdfReadError, TypeError, KeyError, AttributeError, ValueError)
+
+def extract_title_from_metadata(reader):
     """Extract document title from PDF metadata."""
+    if reader is None:
+        return None
     try:
-        reader = PdfReader(pdf_path)
-        if reader.metadata:
-            title = reader.metadata.get('/Title', '').strip()
-            if title:
-                return title
-    except:
-        pass
+        metadata = reader.metadata
+        title = metadata.title if metadata else None
+    except _PYPDF_ERRORS:
+        return None
+    # pypdf hands back the raw object when /Title is not a text string
+    if isinstance(title, str):
+        title = title.strip()
+        if title:
+            return title
     return None
 
-def extract_title_from_content(pdf_path):
+def _iter_chars(page):
+    """Yield (text, size, y0) for each character on a PyMuPDF page.
+
+    y0 is the baseline of the character's span, measured from the bottom
+    of the page to match PDF user space.
+    """
+    page_height = page.rect.height
+    # "dict" returns one string per span instead of a dict per character,
+    # and TEXTFLAGS_TEXT leaves out image blocks we never look at
+    for block in page.get_text("dict", flags=pymupdf.TEXTFLAGS_TEXT)["blocks"]:
+        for line in block.get("lines", []):
+            for span in line["spans"]:
+                size = span["size"]
+                # The baseline is shared by every font on a line, unlike
+                # the bbox bottom, which depends on each font's descender
+                y0 = page_height - span["origin"][1]
+                for text in span["text"]:
+                    yield text, size, y0
+
+def _title_from_first_page(first_page, chars):
+    """Pick the document title from the first page and its characters."""
+    if not chars:
+        return None
+    
+    # Group characters by font size and position
+    font_sizes = defaultdict(list)
+    for char in chars:
+        font_sizes[char[1]].append(char)
+    
+    # Find the largest font size (likely title)
+    if font_sizes:
+        largest_font = max(font_sizes.keys())
+        title_chars = font_sizes[largest_font]
+        
+        # Reconstruct text from characters
+        title_text = ''.join([char[0] for char in title_chars]).strip()
+        
+        # Clean up the title
+        title_lines = title_text.split('\n')
+        for line in title_lines:
+            line = line.strip()
+            if len(line) > 5 and len(line) < 150:
+                return line
+    
+    # Fallback: use first meaningful line
+    text = first_page.get_text()
+    if text:
+        lines = text.split('\n')
+        for line in lines:
+            line = line.strip()
+            if len(line) > 5 and len(line) < 150:
+                return line
+    return None
+
+def extract_title_from_content(data):
     """Extract document title from first page content."""
     try:
-        with pdfplumber.open(pdf_path) as pdf:
-            if len(pdf.pages) > 0:
-                first_page = pdf.pages[0]
-                
-                # Get text with detailed information
-                chars = first_page.chars
-                if not chars:
-                    return None
-                
-                # Group characters by font size and position
-                font_sizes = {}
-                for char in chars:
-                    size = char.get('size', 0)
-                    if size not in font_sizes:
-                        font_sizes[size] = []
-                    font_sizes[size].append(char)
-                
-                # Find the largest font size (likely title)
-                if font_sizes:
-                    largest_font = max(font_sizes.keys())
-                    title_chars = font_sizes[largest_font]
-                    
-                    # Reconstruct text from characters
-                    title_text = ''.join([char['text'] for char in title_chars]).strip()
-                    
-                    # Clean up the title
-                    title_lines = title_text.split('\n')
-                    for line in title_lines:
-                        line = line.strip()
-                        if len(line) > 5 and len(line) < 150:
-                            return line
-                
-                # Fallback: use first meaningful line
-                text = first_page.extract_text()
-                if text:
-                    lines = text.split('\n')
-                    for line in lines:
-                        line = line.strip()
-                        if len(line) > 5 and len(line) < 150:
-                            return line
-    except:
+        with pymupdf.open(stream=data, filetype="pdf") as pdf:
+            if len(pdf) > 0:
+                first_page = pdf[0]
+                return _title_from_first_page(first_page, list(_iter_chars(first_page)))
+    except RuntimeError:
+        # MuPDF reports unreadable documents and pages as RuntimeError
         pass
     return None
 
-def extract_title(pdf_path):
-    """Extract document title from PDF."""
-    # Try metadata first
-    title = extract_title_from_metadata(pdf_path)
-    if title:
-        return title
-    
-    # Try content extraction
-    title = extract_title_from_content(pdf_path)
-    if title:
-        return title
-    
-    return "Untitled Document"
+def is_potential_heading(text, font_size, heading_size, page_width, size_check=True):
+    """Determine if text is likely a heading based on various factors.
 
-def is_potential_heading(text, font_size, avg_font_size, page_width):
-    """Determine if text is likely a heading based on various factors."""
+    With size_check=False only the length and text-pattern rules apply.
+    """
     text = text.strip()
     
     # Skip very short or very long text
@@ -91,154 +118,191 @@ def is_potential_heading(text, font_size, avg_font_size, page_width):
         return False
     
     # Check for heading patterns
-    heading_patterns = [
-        r'^\d+\.?\s+',  # Numbered sections (1. or 1)
-        r'^[A-Z][a-z]*\s+[A-Z]',  # Title Case
-        r'^[A-Z\s]+$',  # ALL CAPS
-        r'^\w+\.\d+',   # Section numbers like 2.1
-    ]
-    
-    for pattern in heading_patterns:
-        if re.match(pattern, text):
-            return True
+    if _HEADING_RE.match(text):
+        return True
     
-    # Check font size (should be larger than average)
-    if font_size > avg_font_size * 1.1:
+    # Check font size against the document's heading threshold
+    if size_check and font_size > heading_size:
         return True
     
     return False
 
-def get_heading_level(font_size, font_size_hierarchy):
-    """Determine heading level based on font size hierarchy."""
+def get_heading_levels(font_size_hierarchy):
+    """Map each font size in the hierarchy to a heading level (H1, H2, H3)."""
     # Sort unique font sizes in descending order
     sorted_sizes = sorted(set(font_size_hierarchy), reverse=True)
     
-    if len(sorted_sizes) <= 1:
-        return "H1"
-    
-    # Map font sizes to heading levels (H1, H2, H3)
-    try:
-        index = sorted_sizes.index(font_size)
-        return f"H{min(index + 1, 3)}"
-    except ValueError:
-        return "H3"
+    # Larger fonts get higher levels; everything past the third size is H3
+    return {size: f"H{min(index + 1, 3)}" for index, size in enumerate(sorted_sizes)}
 
-def extract_outline_from_bookmarks(pdf_path):
+def extract_outline_from_bookmarks(reader):
     """Extract outline from PDF bookmarks if available."""
+    if reader is None:
+        return []
     try:
-        reader = PdfReader(pdf_path)
-        if reader.outline:
-            outline = []
-            
-            def process_bookmark(bookmark_item, level=1):
-                if isinstance(bookmark_item, list):
-                    for item in bookmark_item:
-                        process_bookmark(item, level)
-                else:
-                    title = str(bookmark_item.title).strip()
-                    if title and len(title) > 2:
-                        # Get page number (approximate)
-                        page_num = 1
-                        if hasattr(bookmark_item, 'page'):
-                            try:
-                                page_num = reader.get_destination_page_number(bookmark_item) + 1
-                            except:
-                                pass
-                        
-                        outline.append({
-                            "level": f"H{min(level, 3)}",
-                            "text": title,
-                            "page": page_num
-                        })
-                    
-                    # Process children
-                    if hasattr(bookmark_item, 'children') and bookmark_item.children:
-                        for child in bookmark_item.children:
-                            process_bookmark(child, level + 1)
+        bookmarks = reader.outline
+    except _PYPDF_ERRORS as e:
+        # A malformed outline counts as no bookmarks; content analysis takes over
+        print(f"Error reading bookmarks: {str(e)}")
+        return []
+    if not bookmarks:
+        return []
+    
+    # Map page object numbers to page numbers once instead of
+    # walking the page tree for every bookmark
+    try:
+        page_index = {
+            page.indirect_reference.idnum: i + 1
+            for i, page in enumerate(reader.pages)
+        }
+    except _PYPDF_ERRORS as e:
+        print(f"Error indexing pages for bookmarks: {str(e)}")
+        page_index = {}
+    
+    outline = []
+    
+    # Walk the outline depth-first with an explicit stack. pypdf
+    # nests a bookmark's children in a list right after it.
+    stack = [(bookmarks, 1)]
+    while stack:
+        bookmark_item, level = stack.pop()
+        if isinstance(bookmark_item, list):
+            stack.extend(
+                (item, level + 1 if isinstance(item, list) else level)
+                for item in reversed(bookmark_item)
+            )
+            continue
+        
+        try:
+            title = str(bookmark_item.title).strip()
+        except _PYPDF_ERRORS as e:
+            print(f"Skipping unreadable bookmark: {str(e)}")
+            continue
+        if title and len(title) > 2:
+            # Get page number (approximate)
+            page_num = 1
+            if hasattr(bookmark_item, 'page'):
+                try:
+                    page_num = page_index[bookmark_item.page.idnum]
+                except (AttributeError, KeyError):
+                    # Destinations without an indirect page reference
+                    try:
+                        dest_page = reader.get_destination_page_number(bookmark_item)
+                    except _PYPDF_ERRORS:
+                        dest_page = None
+                    if dest_page is not None and dest_page >= 0:
+                        page_num = dest_page + 1
             
-            process_bookmark(reader.outline)
-            return outline
-    except:
-        pass
-    return []
+            outline.append({
+                "level": f"H{min(level, 3)}",
+                "text": title,
+                "page": page_num
+            })
+    
+    return outline
+
+def extract_title_and_outline_from_content(data, need_title=True):
+    """Extract title and outline from PDF content analysis with one open.
 
-def extract_outline_from_content(pdf_path):
-    """Extract outline from PDF content analysis."""
+    The first-page title work is skipped when need_title is false.
+    """
+    title = None
     outline = []
     
     try:
-        with pdfplumber.open(pdf_path) as pdf:
-            all_font_sizes = []
+        with pymupdf.open(stream=data, filetype="pdf") as pdf:
+            total_size = 0.0
+            total_count = 0
+            pages = []
             potential_headings = []
             
-            # First pass: collect font size information
-            for page_num, page in enumerate(pdf.pages):
-                chars = page.chars
-                for char in chars:
-                    size = char.get('size', 0)
+            # Single pass: collect font size statistics and group lines
+            for page_num, page in enumerate(pdf):
+                page_width = page.rect.width
+                page_max_size = 0
+                
+                # Keep only text and size, as parallel lists. Characters arrive
+                # in reading order, so a new line starts wherever the baseline
+                # moves by more than 0.5pt.
+                texts = []
+                sizes = []
+                line_starts = []
+                line_y = None
+                chars = _iter_chars(page)
+                if page_num == 0 and need_title:
+                    # The title comes from the first page's characters
+                    chars = list(chars)
+                    title = _title_from_first_page(page, chars)
+                for text, size, y in chars:
                     if size > 0:
-                        all_font_sizes.append(size)
+                        total_size += size
+                        total_count += 1
+                        if size > page_max_size:
+                            page_max_size = size
+                    if line_y is None or abs(y - line_y) > 0.5:
+                        line_starts.append(len(texts))
+                        line_y = y
+                    texts.append(text)
+                    sizes.append(size)
+                
+                pages.append((page_num, page_width, page_max_size, texts, sizes, line_starts))
             
-            if not all_font_sizes:
-                return outline
+            if not total_count:
+                return title, outline
             
-            avg_font_size = sum(all_font_sizes) / len(all_font_sizes)
+            avg_font_size = total_size / total_count
+            heading_size = avg_font_size * _HEADING_SIZE_RATIO
             
-            # Second pass: identify potential headings
-            for page_num, page in enumerate(pdf.pages):
-                page_width = page.width
-                
-                # Extract text with formatting information
-                chars = page.chars
-                if not chars:
-                    continue
-                
-                # Group characters by line
-                lines = {}
-                for char in chars:
-                    y = char.get('y0', 0)
-                    if y not in lines:
-                        lines[y] = []
-                    lines[y].append(char)
+            # Identify potential headings now that the average is known
+            for page_num, page_width, page_max_size, texts, sizes, line_starts in pages:
+                # Body-only pages are still scanned, not skipped: pattern
+                # headings can be body-sized. No line on them can pass the size
+                # test, so they only get the pattern check, and a line's
+                # dominant size is computed only once it matches.
+                body_only = page_max_size <= heading_size
                 
                 # Process each line
-                for y_pos in sorted(lines.keys(), reverse=True):
-                    line_chars = sorted(lines[y_pos], key=lambda x: x.get('x0', 0))
-                    line_text = ''.join([char['text'] for char in line_chars]).strip()
+                line_ends = line_starts[1:] + [len(texts)]
+                for start, end in zip(line_starts, line_ends):
+                    line_text = ''.join(texts[start:end]).strip()
                     
                     if not line_text:
                         continue
                     
-                    # Get the dominant font size for this line
-                    font_sizes = [char.get('size', avg_font_size) for char in line_chars]
-                    dominant_font_size = max(set(font_sizes), key=font_sizes.count)
+                    if body_only:
+                        if not is_potential_heading(line_text, None, heading_size, page_width, size_check=False):
+                            continue
+                        dominant_font_size = Counter(sizes[start:end]).most_common(1)[0][0]
+                    else:
+                        # Get the dominant font size for this line
+                        dominant_font_size = Counter(sizes[start:end]).most_common(1)[0][0]
+                        
+                        # Check if this line could be a heading
+                        if not is_potential_heading(line_text, dominant_font_size, heading_size, page_width):
+                            continue
                     
-                    # Check if this line could be a heading
-                    if is_potential_heading(line_text, dominant_font_size, avg_font_size, page_width):
-                        potential_headings.append({
-                            "text": line_text,
-                            "page": page_num + 1,
-                            "font_size": dominant_font_size
-                        })
-            
-            # Remove duplicates and sort
-            seen_texts = set()
-            unique_headings = []
+                    potential_headings.append({
+                        "text": line_text,
+                        "key": line_text.lower(),
+                        "page": page_num + 1,
+                        "font_size": dominant_font_size
+                    })
             
+            # Remove duplicates (first occurrence wins) and sort
+            unique = {}
             for heading in potential_headings:
-                text_key = heading["text"].lower().strip()
-                if text_key not in seen_texts and len(text_key) > 2:
-                    seen_texts.add(text_key)
-                    unique_headings.append(heading)
+                unique.setdefault(heading["key"], heading)
+            unique_headings = list(unique.values())
             
             # Sort by page number
             unique_headings.sort(key=lambda x: (x["page"], -x["font_size"]))
             
             # Create final outline with heading levels
             font_size_hierarchy = [h["font_size"] for h in unique_headings]
+            heading_levels = get_heading_levels(font_size_hierarchy)
             
             for heading in unique_headings:
-                level = get_heading_level(heading["font_size"], font_size_hierarchy)
+                level = heading_levels.get(heading["font_size"], "H3")
                 outline.append({
                     "level": level,
                     "text": heading["text"],
@@ -248,29 +312,36 @@ def extract_outline_from_content(pdf_path):
     except Exception as e:
         print(f"Error extracting outline from content: {str(e)}")
     
-    return outline
-
-def extract_outline(pdf_path):
-    """Extract document outline/structure from PDF."""
-    # Try bookmarks first
-    outline = extract_outline_from_bookmarks(pdf_path)
-    if outline:
-        return outline
-    
-    # Fall back to content analysis
-    return extract_outline_from_content(pdf_path)
+    return title, outline
 
 def process_single_pdf(pdf_path):
     """Process a single PDF and extract title and outline."""
     try:
-        # Extract title
-        title = extract_title(pdf_path)
+        # Read the file once and share the bytes between pypdf and PyMuPDF
+        data = Path(pdf_path).read_bytes()
+        
+        # Open pypdf once for both metadata and bookmarks; PyMuPDF is only
+        # opened when one of them is missing
+        try:
+            reader = PdfReader(io.BytesIO(data))
+        except _PYPDF_ERRORS:
+            reader = None
+        
+        # Try metadata title and bookmarks first
+        title = extract_title_from_metadata(reader)
+        outline = extract_outline_from_bookmarks(reader)
         
-        # Extract outline
-        outline = extract_outline(pdf_path)
+        if not outline:
+            # Fall back to content analysis, which yields the title too
+            content_title, outline = extract_title_and_outline_from_content(
+                data, need_title=not title
+            )
+            title = title or content_title
+        elif not title:
+            title = extract_title_from_content(data)
         
         return {
-            "title": title,
+            "title": title or "Untitled Document",
             "outline": outline
         }
     
@@ -281,6 +352,12 @@ def process_single_pdf(pdf_path):
             "title": "Document",
             "outline": []
         }
+    
+    finally:
+        # Drop MuPDF's cached fonts/images and any lingering page data so
+        # long-lived workers do not grow with every file they handle
+        pymupdf.TOOLS.store_shrink(100)
+        gc.collect()
 
 def process_pdfs():
     """Main function to process all PDFs in the input directory."""
@@ -300,25 +377,23 @@ def process_pdfs():
     
     print(f"Found {len(pdf_files)} PDF files to process")
     
-    for pdf_file in pdf_files:
-        print(f"Processing {pdf_file.name}...")
-        
-        # Process the PDF
-        result = process_single_pdf(pdf_file)
+    # Each PDF is independent, so spread them across worker processes
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        results = executor.map(process_single_pdf, pdf_files, chunksize=1)
         
-        # Create output JSON file
-        output_file = output_dir / f"{pdf_file.stem}.json"
-        
-        try:
-            with open(output_file, "w", encoding="utf-8") as f:
-                json.dump(result, f, indent=4, ensure_ascii=False)
+        for pdf_file, result in zip(pdf_files, results):
+            # Create output JSON file
+            output_file = output_dir / f"{pdf_file.stem}.json"
             
-            print(f"✓ Processed {pdf_file.name} -> {output_file.name}")
-            print(f"  Title: {result['title']}")
-            print(f"  Outline entries: {len(result['outline'])}")
-            
-        except Exception as e:
-            print(f"✗ Error writing output for {pdf_file.name}: {str(e)}")
+            try:
+                output_file.write_bytes(orjson.dumps(result, option=orjson.OPT_INDENT_2))
+                
+                print(f"✓ Processed {pdf_file.name} -> {output_file.name}")
+                print(f"  Title: {result['title']}")
+                print(f"  Outline entries: {len(result['outline'])}")
+                
+            except Exception as e:
+                print(f"✗ Error writing output for {pdf_file.name}: {str(e)}")
 
 if __name__ == "__main__":
     print("Starting PDF processing...")